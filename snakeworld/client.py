@@ -2,18 +2,27 @@ import asyncio
 import logging
 import json
 import websockets
-from snakeworld.common import Snake, Size, Direction, Fruit, Point, GameState
+from snakeworld.codec import CODECS, get_codec
+from snakeworld.common import Snake, Size, Direction, Fruit, Point, GameState, LazyGameState
 
 logger = logging.getLogger(__name__)
 
 
 class BaseClient:
-    def __init__(self, name, server_url='ws://5.39.83.97:8080/'):
+    # LazyGameState only builds the objects a bot looks at, set GameState to
+    # get every snake, fruit and wall built on each update
+    game_state_class = LazyGameState
+
+    def __init__(self, name, server_url='ws://5.39.83.97:8080/', codecs=None):
         self.name = name
         self.server_url = server_url
+        # Codecs proposed to the server, by order of preference
+        self.codecs = list(codecs or CODECS)
+        self.codec = get_codec()
         self.websocket = None
         self.state = None
         self.mysnake = None
+        self.step_gap = 1
     
     def run_until_complete(self):
         asyncio.get_event_loop().run_until_complete(self.run())
@@ -37,23 +46,29 @@ class BaseClient:
                 direction = self.evaluate()
             if direction is not None:
                 print(direction)
-                yield from self.websocket.send(json.dumps({'direction': direction.value}))
+                yield from self.websocket.send(self.codec.dumps({'direction': direction.value}))
 
     @asyncio.coroutine
     def send_init(self):
         logger.info("Initialize client")
-        yield from self.websocket.send(json.dumps({'name': self.name}))
+        yield from self.websocket.send(json.dumps({'name': self.name, 'codecs': self.codecs}))
         logger.info("Client initialized")
         
     @asyncio.coroutine
     def update_game_state(self):
         logger.debug("Update game state")
         raw_data = yield from self.websocket.recv()
+        # Text frames are always JSON, they may precede the codec acknowledgement
+        codec = self.codec if isinstance(raw_data, bytes) else get_codec('json')
         try:
-            data = json.loads(raw_data)
+            data = codec.loads(raw_data)
         except:
             logger.error("Cannot parse %r", raw_data)
             return
+        if 'codec' in data:
+            self.codec = get_codec(data['codec'])
+            logger.info("Server selected codec %s", self.codec.name)
+            return (yield from self.update_game_state())
         if 'error' in data:
             self.error = data['error']
             self.state = None
@@ -61,9 +76,14 @@ class BaseClient:
             return
         if 'size' not in data:
             print(data)
-        new_state = GameState.from_dict(data)
-        if self.state and new_state.step != self.state.step + 1:
-            logger.warning("Frame skip: prev_step=%s, recv_step=%s", self.state.step, new_state.step)
+        new_state = self.game_state_class.from_dict(data)
+        if self.state:
+            # The server lowers the update rate of slow clients, a steady gap is expected
+            step_gap = new_state.step - self.state.step
+            if step_gap != 1:
+                log = logger.warning if step_gap != self.step_gap else logger.debug
+                log("Frame skip: prev_step=%s, recv_step=%s", self.state.step, new_state.step)
+            self.step_gap = step_gap
         self.state = new_state
         if self.state and self.name in self.state.snakes:
             self.mysnake = self.state.snakes[self.name]
@@ -0,0 +1,210 @@
+import collections
+import json
+
+from .utils import json_dumps
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+CODECS = collections.OrderedDict()
+DEFAULT_CODEC = 'json'
+
+
+class Codec:
+    """Serialization format of the messages exchanged with a client."""
+
+    name = None
+
+    def dumps(self, data):
+        raise NotImplementedError()
+
+    def loads(self, raw):
+        raise NotImplementedError()
+
+    def dumps_game_state(self, state):
+        """Encode a GameState, same output as dumps(state.to_dict())."""
+        return self.dumps(state.to_dict())
+
+
+class JsonCodec(Codec):
+    name = 'json'
+
+    POINT = '{"x":%d,"y":%d}'
+    SNAKE = '{"body":[%s],"name":%s,"color":%s,"direction":"%s","best_length":%d,"length":%d,"died":%d,"killed":%d}'
+    STATE = '{"size":{"width":%d,"height":%d},"snakes":[%s],"fruits":[%s],"walls":[%s],"step":%d}'
+
+    def dumps(self, data):
+        return json_dumps(data)
+
+    def loads(self, raw):
+        return json.loads(raw)
+
+    def dumps_game_state(self, state):
+        # Fill the JSON templates from the objects, skips building the to_dict() tree
+        point, encode = self.POINT, self.encode_value
+        snakes = [
+            self.SNAKE % (
+                ','.join([point % (p.x, p.y) for p in snake.body]),
+                encode(snake.name), encode(snake.color), snake.direction.value,
+                snake.best_length, snake.length, snake.died, snake.killed)
+            for snake in state.snakes.values() if snake.active
+        ]
+        return self.STATE % (
+            state.size.width, state.size.height,
+            ','.join(snakes),
+            ','.join([point % (f.position.x, f.position.y) for f in state.fruits]),
+            ','.join([point % (w.position.x, w.position.y) for w in state.walls]),
+            state.step)
+
+    @staticmethod
+    def encode_value(value):
+        # name and color come from the client, they may not be strings
+        if isinstance(value, str):
+            return json.encoder.encode_basestring_ascii(value)
+        return json_dumps(value)
+
+
+class OrjsonCodec(JsonCodec):
+    """JsonCodec backed by orjson, the messages are still sent as text."""
+
+    def dumps(self, data):
+        return orjson.dumps(data).decode('utf8')
+
+    def loads(self, raw):
+        return orjson.loads(raw)
+
+    def dumps_game_state(self, state):
+        # orjson encodes the to_dict() tree faster than the templates are filled
+        return self.dumps(state.to_dict())
+
+
+class MsgpackCodec(Codec):
+    name = 'msgpack'
+
+    MAX_CACHED_POINTS = 100000
+
+    def __init__(self):
+        packb = msgpack.packb
+        self.state_keys = [packb(k) for k in ('size', 'snakes', 'fruits', 'walls', 'step')]
+        self.snake_keys = [packb(k) for k in (
+            'body', 'name', 'color', 'direction', 'best_length', 'length', 'died', 'killed')]
+        self.points = {}
+
+    def dumps(self, data):
+        return msgpack.packb(data)
+
+    def loads(self, raw):
+        return msgpack.unpackb(raw, raw=False)
+
+    def dumps_game_state(self, state):
+        # Assemble the message from packed fragments, points are packed once per position
+        packb, keys = msgpack.packb, self.state_keys
+        snakes = [self.pack_snake(snake) for snake in state.snakes.values() if snake.active]
+        return b''.join([
+            b'\x85',
+            keys[0], packb(state.size.to_dict()),
+            keys[1], self.pack_array_header(len(snakes)), b''.join(snakes),
+            keys[2], self.pack_points([f.position for f in state.fruits]),
+            keys[3], self.pack_points([w.position for w in state.walls]),
+            keys[4], packb(state.step),
+        ])
+
+    def pack_snake(self, snake):
+        packb, keys = msgpack.packb, self.snake_keys
+        return b''.join([
+            b'\x88',
+            keys[0], self.pack_points(snake.body),
+            keys[1], packb(snake.name),
+            keys[2], packb(snake.color),
+            keys[3], packb(snake.direction.value),
+            keys[4], packb(snake.best_length),
+            keys[5], packb(snake.length),
+            keys[6], packb(snake.died),
+            keys[7], packb(snake.killed),
+        ])
+
+    def pack_points(self, points):
+        cache = self.points
+        fragments = [self.pack_array_header(len(points))]
+        for p in points:
+            key = (p.x, p.y)
+            fragment = cache.get(key)
+            if fragment is None:
+                fragment = msgpack.packb(p.to_dict())
+                if len(cache) < self.MAX_CACHED_POINTS:
+                    cache[key] = fragment
+            fragments.append(fragment)
+        return b''.join(fragments)
+
+    @staticmethod
+    def pack_array_header(n):
+        if n < 16:
+            return bytes((0x90 | n,))
+        elif n < 0x10000:
+            return b'\xdc' + n.to_bytes(2, 'big')
+        return b'\xdd' + n.to_bytes(4, 'big')
+
+
+def register_codec(codec):
+    CODECS[codec.name] = codec
+
+
+def get_codec(name=DEFAULT_CODEC):
+    if name not in CODECS:
+        raise ValueError("Unknown codec %r" % name)
+    return CODECS[name]
+
+
+def negotiate_codec(names):
+    """First codec of the client's preference list known by the server,
+    the default codec when there is none."""
+    for name in names:
+        if name in CODECS:
+            return CODECS[name]
+    return CODECS[DEFAULT_CODEC]
+
+
+if msgpack is not None:
+    register_codec(MsgpackCodec())
+register_codec(OrjsonCodec() if orjson is not None else JsonCodec())
+
+
+if __name__ == '__main__':
+    import sys
+    import timeit
+
+    from .common import GameState, Size, Snake, Fruit
+
+    def create_state(nb_snakes, length):
+        state = GameState(Size(200, 100))
+        for i in range(nb_snakes):
+            snake = Snake.create(None, state.size)
+            # A color sent by a client may be any JSON value
+            snake.activate('bot%s' % i, None if i % 2 else i)
+            snake.length = length
+            for _ in range(length):
+                snake.move()
+            state.snakes[snake.name] = snake
+        state.fruits = [Fruit.create_random(state.size) for _ in range(20)]
+        return state
+
+    def bench(func, number=200):
+        return timeit.timeit(func, number=number) / number * 1e6
+
+    nb_snakes = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    state = create_state(nb_snakes, 40)
+    for codec in CODECS.values():
+        raw = codec.dumps_game_state(state)
+        assert raw == codec.dumps(state.to_dict())
+        print('%s (%s): %.3f ko' % (codec.name, codec.__class__.__name__, len(raw) / 1000))
+        print('    dumps(to_dict()):   %8.1f us' % bench(lambda: codec.dumps(state.to_dict())))
+        print('    dumps_game_state(): %8.1f us' % bench(lambda: codec.dumps_game_state(state)))
+        print('    loads():            %8.1f us' % bench(lambda: codec.loads(raw)))
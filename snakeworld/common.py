@@ -1,8 +1,14 @@
+import collections.abc
 import enum
 import random
 import uuid
 import cgi
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 class Direction(enum.Enum):
     LEFT = 'l'
@@ -107,7 +113,7 @@ class GameObject:
 
 
 class Snake(GameObject):
-    def __init__(self, websocket):
+    def __init__(self, websocket, name=None, color=None):
         super().__init__(None)
         self.body = []
         self.direction = Direction.UP
@@ -115,11 +121,18 @@ class Snake(GameObject):
         self.best_length = 1
         self.died = 0
         self.killed = 0
-        self.name = str("Anonymous-%s" % uuid.uuid4())
+        if name is None:
+            name = str("Anonymous-%s" % uuid.uuid4())
+        self.name = name
         self.websocket = websocket
-        r = lambda: random.randint(100,255)
-        self.color = '#%02X%02X%02X' % (r(),r(),r())
+        if color is None:
+            r = lambda: random.randint(100,255)
+            color = '#%02X%02X%02X' % (r(),r(),r())
+        self.color = color
         self.active = False
+        # Set on the snakes summarized by the server, see to_summary_dict()
+        self.summary = False
+        self.bbox = None
         
     @classmethod
     def create(cls, websocket, map_size):
@@ -156,8 +169,23 @@ class Snake(GameObject):
         self.position = head
  
     def to_dict(self):
+        data = {'body': [p.to_dict() for p in self.body]}
+        data.update(self.to_dict_header())
+        return data
+
+    def to_summary_dict(self):
+        """Reduced form of to_dict(): only the head is kept in the body,
+        the rest of the snake is described by its length and bounding box."""
+        xs = [p.x for p in self.body]
+        ys = [p.y for p in self.body]
+        data = {'body': [self.body[0].to_dict()]}
+        data.update(self.to_dict_header())
+        data['bbox'] = [min(xs), min(ys), max(xs), max(ys)]
+        data['summary'] = True
+        return data
+
+    def to_dict_header(self):
         return {
-            'body': [p.to_dict() for p in self.body],
             'name': self.name,
             'color': self.color,
             'direction': self.direction.value,
@@ -166,19 +194,19 @@ class Snake(GameObject):
             'died': self.died,
             'killed': self.killed,
         }
-        
+
     @classmethod
     def from_dict(cls, data):
-        o = cls(None)
+        o = cls(None, data['name'], data['color'])
         o.body = [Point.from_dict(d) for d in data['body']]
         o.position = o.body[0]
-        o.name = data['name']
-        o.color = data['color']
         o.direction = Direction(data['direction'])
         o.best_length = data['best_length']
         o.length = data['length']
         o.died = data['died']
         o.killed = data['killed']
+        o.summary = data.get('summary', False)
+        o.bbox = data.get('bbox')
         return o
         
     def change_direction(self, direction):
@@ -230,3 +258,104 @@ class GameState:
             walls=[Wall.from_dict(d) for d in data['walls']],
             step=data['step'],
         )
+
+
+class LazySnakes(collections.abc.Mapping):
+    """Snakes of a LazyGameState by name, built on first access."""
+
+    def __init__(self, data):
+        self.data = data
+        self.index = None
+        self.cache = {}
+
+    def __getitem__(self, name):
+        snake = self.cache.get(name)
+        if snake is None:
+            snake = self.cache[name] = Snake.from_dict(self.get_index()[name])
+        return snake
+
+    def __contains__(self, name):
+        return name in self.get_index()
+
+    def get_index(self):
+        if self.index is None:
+            self.index = dict((d['name'], d) for d in self.data)
+        return self.index
+
+    def raw(self, name, default=None):
+        """Decoded dict of the snake `name`, without building the Snake."""
+        return self.get_index().get(name, default)
+
+    def __iter__(self):
+        return (d['name'] for d in self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+
+class LazyGameState:
+    """Read-only GameState backed by the decoded game update.
+
+    Snakes, fruits and walls are only built when they are accessed. The
+    *_array() methods give the coordinates of the map as NumPy arrays of
+    shape (n, 2), they need NumPy to be installed.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.step = data['step']
+        self.snakes = LazySnakes(data['snakes'])
+        self._size = None
+        self._fruits = None
+        self._walls = None
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data)
+
+    def to_dict(self):
+        return self.data
+
+    @property
+    def size(self):
+        if self._size is None:
+            self._size = Size.from_dict(self.data['size'])
+        return self._size
+
+    @property
+    def fruits(self):
+        if self._fruits is None:
+            self._fruits = [Fruit.from_dict(d) for d in self.data['fruits']]
+        return self._fruits
+
+    @property
+    def walls(self):
+        if self._walls is None:
+            self._walls = [Wall.from_dict(d) for d in self.data['walls']]
+        return self._walls
+
+    def fruit_array(self):
+        return self.to_array(self.data['fruits'])
+
+    def wall_array(self):
+        return self.to_array(self.data['walls'])
+
+    def head_array(self):
+        """Heads of the snakes, in the order of self.snakes."""
+        return self.to_array([d['body'][0] for d in self.data['snakes']])
+
+    def body_array(self, name=None):
+        """Body of the snake `name`, or of every snake if `name` is None."""
+        if name is not None:
+            data = self.snakes.raw(name)
+            return self.to_array(data['body'] if data is not None else [])
+        return self.to_array([p for d in self.data['snakes'] for p in d['body']])
+
+    @staticmethod
+    def to_array(points):
+        if numpy is None:
+            raise ImportError('NumPy is required for coordinate arrays')
+        array = numpy.empty((len(points), 2), dtype=numpy.int32)
+        array[:, 0] = [p['x'] for p in points]
+        array[:, 1] = [p['y'] for p in points]
+        return array
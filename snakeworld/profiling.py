@@ -0,0 +1,237 @@
+import asyncio
+import collections
+import gc
+import json
+import logging
+import os
+import signal
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class TraceRecorder:
+    """Bounded ring of trace events.
+
+    Events use the Trace Event Format, dumps can be opened with
+    chrome://tracing or https://ui.perfetto.dev.
+    """
+
+    PID = 1
+
+    def __init__(self, maxlen=100000):
+        self.events = collections.deque(maxlen=maxlen)
+        self.tracks = {}
+        self.gc_start = None
+
+    def track(self, name):
+        """Thread id of the track `name`, the viewers show one lane per track."""
+        tid = self.tracks.get(name)
+        if tid is None:
+            tid = self.tracks[name] = len(self.tracks) + 1
+        return tid
+
+    def span(self, name, start, end, track='game loop', **args):
+        self.events.append({
+            'name': name, 'ph': 'X', 'pid': self.PID, 'tid': self.track(track),
+            'ts': start * 1e6, 'dur': (end - start) * 1e6, 'args': args,
+        })
+
+    def counter(self, name, value, when=None):
+        if when is None:
+            when = time.monotonic()
+        self.events.append({
+            'name': name, 'ph': 'C', 'pid': self.PID, 'tid': 0,
+            'ts': when * 1e6, 'args': {name: value},
+        })
+
+    def on_gc(self, phase, info):
+        if phase == 'start':
+            self.gc_start = time.monotonic()
+        elif self.gc_start is not None:
+            self.span('gc', self.gc_start, time.monotonic(), track='gc',
+                      generation=info['generation'], collected=info['collected'])
+            self.gc_start = None
+
+    def to_dict(self):
+        """Copy of the ring, cheap enough to be taken in the game loop."""
+        metadata = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': self.PID, 'tid': tid, 'args': {'name': name}}
+            for name, tid in self.tracks.items()
+        ]
+        return {'traceEvents': metadata + list(self.events), 'displayTimeUnit': 'ms'}
+
+    @staticmethod
+    def dump(trace, filepath):
+        """Write a to_dict() copy, slow on a full ring, run it out of the game loop."""
+        tmp_filepath = filepath + '.tmp'
+        with open(tmp_filepath, 'w') as f:
+            json.dump(trace, f)
+        os.rename(tmp_filepath, filepath)
+        logger.info('Trace dumped to %s (%s events)', filepath, len(trace['traceEvents']))
+        return filepath
+
+
+class SamplingProfiler:
+    """CPU profiler sampling the stack of the main thread on SIGPROF.
+
+    Samples are dumped as collapsed stacks, the input format of
+    flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = collections.Counter()
+        self.running = False
+
+    def start(self, interval=None):
+        """Start sampling, or change the interval of the running sampler."""
+        if interval is not None:
+            self.interval = interval
+        if not self.running:
+            self.samples.clear()
+            signal.signal(signal.SIGPROF, self.on_sample)
+            self.running = True
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        if not self.running:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        self.running = False
+
+    def on_sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s (%s:%s)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        self.samples[';'.join(reversed(stack))] += 1
+
+    @staticmethod
+    def dump(samples, filepath):
+        with open(filepath, 'w') as f:
+            for stack, count in samples.most_common():
+                f.write('%s %s\n' % (stack, count))
+        logger.info('CPU profile dumped to %s (%s samples)', filepath, sum(samples.values()))
+        return filepath
+
+
+class Profiler:
+    """Profiling mode of the GameEngine.
+
+    Records the ticks in a TraceRecorder, dumps it automatically when a tick
+    is too slow, and listens on a local control socket accepting one command
+    per connection:
+
+    * "dump [filepath]": dump the trace ring
+    * "profile start [interval_ms]": start the sampling profiler
+    * "profile stop [filepath]": stop the sampling profiler and dump the samples
+    * "status"
+    """
+
+    CONTROL_FILEPATH = './snakeworld.sock'
+    AUTO_DUMP_INTERVAL = 60
+
+    def __init__(self, trace_dir='.', maxlen=100000):
+        self.trace_dir = trace_dir
+        self.recorder = TraceRecorder(maxlen)
+        self.sampler = SamplingProfiler()
+        self.last_auto_dump = None
+        self.server = None
+        # Client tracks are numbered slots reused by the next connections,
+        # the number of tracks is bounded by the number of connections
+        self.client_slots = {}
+        self.free_slots = []
+
+    @asyncio.coroutine
+    def start(self):
+        gc.callbacks.append(self.recorder.on_gc)
+        if os.path.exists(self.CONTROL_FILEPATH):
+            os.remove(self.CONTROL_FILEPATH)
+        self.server = yield from asyncio.start_unix_server(self.on_control, self.CONTROL_FILEPATH)
+        logger.info('Profiler control socket listening on %s', self.CONTROL_FILEPATH)
+
+    def close(self):
+        if self.recorder.on_gc in gc.callbacks:
+            gc.callbacks.remove(self.recorder.on_gc)
+        self.sampler.stop()
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            os.remove(self.CONTROL_FILEPATH)
+
+    def record_tick(self, step, phases):
+        """Record the spans of one tick, `phases` is a list of (name, start, end)."""
+        recorder = self.recorder
+        recorder.span('tick', phases[0][1], phases[-1][2], step=step)
+        for name, start, end in phases:
+            recorder.span(name, start, end, step=step)
+
+    def record_send(self, name, start, end, size, step):
+        slot = self.client_slots.get(name)
+        if slot is None:
+            slot = self.free_slots.pop() if self.free_slots else len(self.client_slots)
+            self.client_slots[name] = slot
+        self.recorder.span('send', start, end, track='client %s' % slot, client=name, size=size, step=step)
+
+    def release_client(self, name):
+        slot = self.client_slots.pop(name, None)
+        if slot is not None:
+            self.free_slots.append(slot)
+
+    def record_encode(self, name, start, end, codec, size):
+        self.recorder.span(name, start, end, codec=codec, size=size)
+
+    def record_loop_lag(self, lag):
+        self.recorder.counter('loop_lag_ms', lag * 1000)
+
+    def on_slow_tick(self, step):
+        now = time.monotonic()
+        if self.last_auto_dump is None or now - self.last_auto_dump > self.AUTO_DUMP_INTERVAL:
+            self.last_auto_dump = now
+            future = self.dump_trace(os.path.join(self.trace_dir, 'trace-slow-%s.json' % step))
+            future.add_done_callback(self.on_dump_done)
+
+    def on_dump_done(self, future):
+        if future.exception() is not None:
+            logger.error('Error dumping trace: %r', future.exception())
+
+    def dump_trace(self, filepath=None):
+        """Copy the ring and write it in an executor, returns the future of the filepath."""
+        if filepath is None:
+            filepath = os.path.join(self.trace_dir, 'trace-%d.json' % time.time())
+        return asyncio.get_event_loop().run_in_executor(
+            None, self.recorder.dump, self.recorder.to_dict(), filepath)
+
+    @asyncio.coroutine
+    def handle_command(self, line):
+        args = line.split()
+        if args == ['status']:
+            return 'events=%s, sampling=%s' % (len(self.recorder.events), self.sampler.running)
+        elif args[:1] == ['dump']:
+            return (yield from self.dump_trace(*args[1:2]))
+        elif args[:2] == ['profile', 'start']:
+            self.sampler.start(float(args[2]) / 1000 if len(args) > 2 else None)
+            return 'sampling every %.1fms' % (self.sampler.interval * 1000)
+        elif args[:2] == ['profile', 'stop']:
+            self.sampler.stop()
+            filepath = args[2] if len(args) > 2 else os.path.join(self.trace_dir, 'profile-%d.txt' % time.time())
+            return (yield from asyncio.get_event_loop().run_in_executor(
+                None, self.sampler.dump, collections.Counter(self.sampler.samples), filepath))
+        raise ValueError('Unknown command %r' % line)
+
+    @asyncio.coroutine
+    def on_control(self, reader, writer):
+        try:
+            line = yield from reader.readline()
+            try:
+                reply = yield from self.handle_command(line.decode('utf8').strip())
+            except Exception as ex:
+                reply = 'error: %s' % ex
+            writer.write((reply + '\n').encode('utf8'))
+            yield from writer.drain()
+        finally:
+            writer.close()
@@ -4,15 +4,14 @@ import csv
 import json
 import logging
 import math
-import msgpack
 import os
 import time
 from statistics import mean
 import websockets
 
+from .codec import CODECS, get_codec
 from .common import *
 from .client import BaseClient
-from .utils import json_dumps
 
 
 logger = logging.getLogger(__name__)
@@ -59,7 +58,7 @@ class ReadOnlyProxy:
         self.server_url = server_url
         self.websocket = None
         self.compressor = compressor
-        self.pack = pack
+        self.codec = get_codec(pack)
         self.queues = []
         self.compress_ratios = collections.deque(maxlen=100)
 
@@ -79,18 +78,19 @@ class ReadOnlyProxy:
     def loop(self):
         logger.info('Proxy started')
         while self.websocket.open:
-            # XXX This could be optimized if pack is 'json' and compression is not activated
-            gamestate, size = yield from self.recv_game_state()
+            gamestate, raw_data = yield from self.recv_game_state()
             if gamestate is None:
                 logger.warning('gamestate is None')
                 continue
             step = gamestate['step']
-            if self.compressor is not None:
-                gamestate = self.compressor.compress(gamestate)
-            if self.pack == self.PACK_JSON:
-                gamestate = json_dumps(gamestate)
+            size = len(raw_data)
+            if self.compressor is None and self.codec.name == self.PACK_JSON:
+                # The server already speaks JSON, forward the frame as is
+                gamestate = raw_data
             else:
-                gamestate = msgpack.packb(gamestate)
+                if self.compressor is not None:
+                    gamestate = self.compressor.compress(gamestate)
+                gamestate = self.codec.dumps(gamestate)
             self.compress_ratios.append(size / len(gamestate) - 1)
             if step % self.compress_ratios.maxlen == 0:
                 logger.info('Compression ratio: %.2f%%', mean(self.compress_ratios) * 100)
@@ -106,14 +106,15 @@ class ReadOnlyProxy:
         logger.debug('Update game state')
         raw_data = yield from self.websocket.recv()
         try:
-            return json.loads(raw_data), len(raw_data)
+            data = get_codec('json').loads(raw_data)
         except:
             logger.error('Cannot parse %r', raw_data)
-            return None, 0
+            return None, raw_data
         if 'error' in data:
             error = data['error']
             logger.warning('Got an error from server: %s', error)
-            return None, 0
+            return None, raw_data
+        return data, raw_data
 
     @asyncio.coroutine
     def on_client(self, websocket, path):
@@ -139,20 +140,15 @@ if __name__ == '__main__':
     logger.setLevel('INFO')
 
     def compare(data):
-        js = json.dumps(data, separators=(',', ':')).encode('utf8')
-        m = msgpack.packb(data)
         compressed = compressor.compress(data)
-        m2 = msgpack.packb(compressed)
-        js2 = json.dumps(compressed, separators=(',', ':')).encode('utf8')
-        print('json: %.3f ko' % (len(js) / 1000))
-        print('msgpack: %.3f ko' % (len(m) / 1000))
-        print('json (compressed): %.3f ko' % (len(js2) / 1000))
-        print('msgpack (compressed): %.3f ko' % (len(m2) / 1000))
+        for codec in CODECS.values():
+            print('%s: %.3f ko' % (codec.name, len(codec.dumps(data)) / 1000))
+            print('%s (compressed): %.3f ko' % (codec.name, len(codec.dumps(compressed)) / 1000))
 
     compressor = GameStateCompressor()
     kwargs = {
         'compressor': compressor,
-        'pack': ReadOnlyProxy.PACK_MSGPACK,
+        'pack': ReadOnlyProxy.PACK_MSGPACK if ReadOnlyProxy.PACK_MSGPACK in CODECS else ReadOnlyProxy.PACK_JSON,
     }
     if len(sys.argv) > 1:
         kwargs['server_url'] = sys.argv[1]
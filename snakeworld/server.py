@@ -1,29 +1,168 @@
 import asyncio
 import collections
 import csv
+import enum
 import json
 import logging
 import math
 import time
 import os
+import sys
 import websockets
 
+from .codec import get_codec, negotiate_codec
 from .common import *
+from .profiling import Profiler
 from .utils import json_dumps
 
 
 logger = logging.getLogger(__name__)
 
 
+class LevelOfDetail(enum.IntEnum):
+    FULL = 0     # every snake is sent with its whole body
+    NEARBY = 1   # snakes far from the client's snake are summarized
+    MINIMAL = 2  # every snake but the client's own is summarized
+
+
+class ClientLink:
+    """Send statistics of a client connection.
+
+    The link measures how long the sends to its client take and adapts the
+    level of detail of the payloads and the number of steps between two
+    updates so that there is never more than one frame in flight.
+    """
+
+    MAX_INTERVAL = 10
+    RECOVERY_SENDS = 20
+    SMOOTHING = 0.2
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.is_updating = False
+        self.interval = 1
+        self.lod = LevelOfDetail.FULL
+        self.codec = get_codec()
+        self.latency = None
+        self.throughput = None
+        self.last_step = None
+        self.good_sends = 0
+        self.late = False
+
+    def is_due(self, step):
+        return self.last_step is None or step - self.last_step >= self.interval
+
+    def record_send(self, size, latency):
+        self.latency = self.smooth(self.latency, latency)
+        self.throughput = self.smooth(self.throughput, size / max(latency, 1e-6))
+        late, self.late = self.late, False
+        if latency > self.budget * self.interval:
+            if not late:
+                self.slow_down()
+        elif latency < self.budget * self.interval / 2:
+            self.good_sends += 1
+
+    def record_skip(self):
+        # A frame is due while the previous one is still in flight, only the
+        # first skip of a send counts, record_send() won't count it again
+        if not self.late:
+            self.late = True
+            self.slow_down()
+
+    def slow_down(self):
+        # Degrade the payload first so that the client stays current, then the rate
+        self.good_sends = 0
+        if self.lod < LevelOfDetail.MINIMAL:
+            self.lod = LevelOfDetail(self.lod + 1)
+        else:
+            self.interval = min(self.interval * 2, self.MAX_INTERVAL)
+
+    @property
+    def can_speed_up(self):
+        return self.good_sends >= self.RECOVERY_SENDS
+
+    def speed_up(self, full_size):
+        """`full_size` returns the size of a full payload, it is only called
+        when the level of detail may be raised."""
+        self.good_sends = 0
+        if self.interval > 1:
+            self.interval -= 1
+        elif self.lod > LevelOfDetail.FULL and full_size() / self.throughput < self.budget / 2:
+            self.lod = LevelOfDetail(self.lod - 1)
+
+    def smooth(self, average, value):
+        if average is None:
+            return value
+        return average + self.SMOOTHING * (value - average)
+
+    @property
+    def is_degraded(self):
+        return self.interval > 1 or self.lod > LevelOfDetail.FULL
+
+
+class FramePacker:
+    """Payloads of one step.
+
+    The full payload is shared by every client, reduced payloads are only
+    built for the clients that need them.
+    """
+
+    NEARBY_RADIUS = 40
+
+    def __init__(self, state, profiler=None):
+        self.game_state = state
+        self.profiler = profiler
+        self.full = {}
+        self.state = None
+        self.snakes = None
+        self.summaries = None
+
+    def pack_full(self, codec):
+        payload = self.full.get(codec.name)
+        if payload is None:
+            start = time.monotonic()
+            payload = self.full[codec.name] = codec.dumps_game_state(self.game_state)
+            if self.profiler is not None:
+                self.profiler.record_encode('encode_full', start, time.monotonic(), codec.name, len(payload))
+        return payload
+
+    def pack(self, viewer, lod, codec):
+        if lod == LevelOfDetail.FULL:
+            return self.pack_full(codec)
+        start = time.monotonic()
+        if self.summaries is None:
+            self.state = self.game_state.to_dict()
+            self.snakes = [snake for snake in self.game_state.snakes.values() if snake.active]
+            self.summaries = [snake.to_summary_dict() for snake in self.snakes]
+        radius = self.NEARBY_RADIUS if lod == LevelOfDetail.NEARBY else 0
+        snakes = []
+        for snake, data, summary in zip(self.snakes, self.state['snakes'], self.summaries):
+            if snake is viewer or (radius and self.bbox_distance(summary['bbox'], viewer.position) <= radius):
+                snakes.append(data)
+            else:
+                snakes.append(summary)
+        payload = codec.dumps(dict(self.state, snakes=snakes))
+        if self.profiler is not None:
+            self.profiler.record_encode('encode_reduced', start, time.monotonic(), codec.name, len(payload))
+        return payload
+
+    @staticmethod
+    def bbox_distance(bbox, point):
+        x_min, y_min, x_max, y_max = bbox
+        return max(x_min - point.x, 0, point.x - x_max) + max(y_min - point.y, 0, point.y - y_max)
+
+
 class GameEngine(GameState):
 
     BACKUP_FILEPATH = './save.txt'
+    LOOP_TIME = 0.15
 
-    def __init__(self):
+    def __init__(self, profiler=None):
         super().__init__(Size(200, 100))
+        self.profiler = profiler
         self.max_fruits = 20
         self.actions = {}
-        self.is_updating = collections.defaultdict(lambda: False)
+        self.links = collections.defaultdict(lambda: ClientLink(self.LOOP_TIME))
         self.scores = {}
 
     def load(self):
@@ -55,12 +194,13 @@ class GameEngine(GameState):
         start_server = websockets.serve(self.on_client, '0.0.0.0', 8080)
         asyncio.get_event_loop().run_until_complete(start_server)
         logger.info("Listen")
+        if self.profiler is not None:
+            asyncio.get_event_loop().run_until_complete(self.profiler.start())
         asyncio.get_event_loop().run_until_complete(self.loop())
     
     @asyncio.coroutine
     def loop(self):
         logger.info("Engine started")
-        LOOP_TIME = 0.15
         try:
             logger.info("Create fruits")
             for i in range(self.max_fruits):
@@ -72,27 +212,35 @@ class GameEngine(GameState):
                 #    logger.info("time before last start : %.3fs", time.monotonic() - start)
                 start = time.monotonic()
                 self.apply_actions()
-                t_apply_actions = time.monotonic() - start
+                t1 = time.monotonic()
                 for snake in self.snakes.values():
                     if snake.active:
                         snake.move()
-                t_move = time.monotonic() - start - t_apply_actions
+                t2 = time.monotonic()
                 self.check_collisions()
-                t_check_collisions = time.monotonic() - start - t_move
+                t3 = time.monotonic()
                 self.update_clients(self.step)
-                t_update_clients = time.monotonic() - start - t_check_collisions
+                t4 = time.monotonic()
                 self.gc_snakes()
-                t_gc_snakes = time.monotonic() - start - t_update_clients
+                t5 = time.monotonic()
+                if self.profiler is not None:
+                    self.profiler.record_tick(self.step, [
+                        ('apply_actions', start, t1), ('move', t1, t2), ('check_collisions', t2, t3),
+                        ('update_clients', t3, t4), ('gc_snakes', t4, t5)])
                 self.step += 1
-                ellapsed_time = time.monotonic() - start
-                if ellapsed_time > LOOP_TIME:
+                ellapsed_time = t5 - start
+                if ellapsed_time > self.LOOP_TIME:
                     logger.warning("Ellapsed time for step %s: %.3fs", self.step, ellapsed_time)
                     logger.warning("t_apply_actions=%.3f, t_move=%.3f, t_check_collisions=%.3f, t_update_clients=%.3f, t_gc_snakes=%.3f" % (
-                        t_apply_actions, t_move, t_check_collisions, t_update_clients, t_gc_snakes))
+                        t1 - start, t2 - t1, t3 - t2, t4 - t3, t5 - t4))
+                    if self.profiler is not None:
+                        self.profiler.on_slow_tick(self.step)
                 else:
-                    # yield from asyncio.sleep(LOOP_TIME - ellapsed_time)
+                    # yield from asyncio.sleep(self.LOOP_TIME - ellapsed_time)
                     # for bots, it's better to always give the same time to compute strategy
-                    yield from asyncio.sleep(LOOP_TIME)
+                    yield from asyncio.sleep(self.LOOP_TIME)
+                    if self.profiler is not None:
+                        self.profiler.record_loop_lag(time.monotonic() - t5 - self.LOOP_TIME)
                 if self.step % 100 == 0:
                     self.print_stats()
                     self.save()
@@ -100,8 +248,9 @@ class GameEngine(GameState):
             logger.exception("Error on run")
             
     def print_stats(self):
-        print("step=%s, snakes=%s, active_snakes=%s" % (
-            self.step, len(self.snakes), sum(1 for s in self.snakes.values() if s.active)))
+        print("step=%s, snakes=%s, active_snakes=%s, degraded_clients=%s" % (
+            self.step, len(self.snakes), sum(1 for s in self.snakes.values() if s.active),
+            sum(1 for l in self.links.values() if l.is_degraded)))
             
     def apply_actions(self):
         to_remove = []
@@ -161,24 +310,38 @@ class GameEngine(GameState):
         snake.active = True
     
     def update_clients(self, step):
-        game_state = self.pack_game_state()
+        packer = FramePacker(self, self.profiler)
         for snake in self.snakes.values():
             if snake.websocket.open:
-                if self.is_updating[snake.name]:
+                link = self.links[snake.name]
+                if not link.is_due(step):
+                    continue
+                if link.is_updating:
                     logger.warning("Snake %s is still updating, skipping frame %s", snake.name, step)
+                    link.record_skip()
                 else:
-                    asyncio.async(self.update_client(snake, game_state))
+                    if link.can_speed_up:
+                        link.speed_up(lambda: len(packer.pack_full(link.codec)))
+                    link.last_step = step
+                    game_state = packer.pack(snake, link.lod, link.codec)
+                    asyncio.async(self.update_client(snake, link, game_state))
             
     @asyncio.coroutine
-    def update_client(self, snake, game_state):
-        self.is_updating[snake.name] = True
+    def update_client(self, snake, link, game_state):
+        link.is_updating = True
         try:
             if snake.websocket.open:
+                start = time.monotonic()
                 yield from snake.websocket.send(game_state)
+                end = time.monotonic()
+                link.record_send(len(game_state), end - start)
+                # The link is gone when the snake closed during the send
+                if self.profiler is not None and self.links.get(snake.name) is link:
+                    self.profiler.record_send(snake.name, start, end, len(game_state), link.last_step)
         except Exception as ex:
             logger.exception("Error during update_client for snake %s: %r", snake.name, ex)
         finally:
-            self.is_updating[snake.name] = False
+            link.is_updating = False
             
     def gc_snakes(self):
         to_close = []
@@ -188,9 +351,6 @@ class GameEngine(GameState):
         for snake in to_close:
             self.close_snake(snake)
     
-    def pack_game_state(self):
-        return json_dumps(self.to_dict())
-    
     @asyncio.coroutine
     def on_client(self, websocket, path):
         snake = None
@@ -202,10 +362,21 @@ class GameEngine(GameState):
             name = init_data['name']
             if name and name not in self.snakes:
                 del self.snakes[snake.name]
+                self.links.pop(snake.name, None)
+                if self.profiler is not None:
+                    self.profiler.release_client(snake.name)
                 snake.activate(name, init_data.get('color'))
                 # Restore previous data
                 if name in self.scores:
                     snake.best_length = self.scores[name]
+                codec = negotiate_codec(init_data.get('codecs', []))
+                if 'codecs' in init_data:
+                    # Acknowledge before registering the snake, no frame may use the codec before
+                    yield from websocket.send(json_dumps({'codec': codec.name}))
+                    if name in self.snakes:
+                        yield from websocket.send('Error name already in use')
+                        return
+                self.links[snake.name].codec = codec
                 self.snakes[snake.name] = snake
                 while websocket.open:
                     raw_msg = yield from websocket.recv()
@@ -213,12 +384,12 @@ class GameEngine(GameState):
                         break
                     logger.debug("Recv %r", raw_msg)
                     try:
-                        msg = json.loads(raw_msg)
+                        msg = codec.loads(raw_msg)
                         if msg:
                             direction = Direction(msg['direction'])
                             self.actions[snake.name] = direction
                     except Exception as ex:
-                        yield from websocket.send(json_dumps({'error': str(ex)}))
+                        yield from websocket.send(codec.dumps({'error': str(ex)}))
                 print('Client closed')
             else:
                 yield from websocket.send('Error name already in use')
@@ -244,9 +415,11 @@ class GameEngine(GameState):
         if name in self.actions:
             logger.info("Remove from actions")
             del self.actions[name]
-        if name in self.is_updating:
-            logger.info("Remove from is_updating")
-            del self.is_updating[name]
+        if name in self.links:
+            logger.info("Remove from links")
+            del self.links[name]
+        if self.profiler is not None:
+            self.profiler.release_client(name)
         if snake.websocket.open:
             logger.warning("Websocket was not closed")
             asyncio.async(snake.websocket.close())
@@ -257,11 +430,13 @@ if __name__ == '__main__':
     logger.addHandler(logging.StreamHandler())
     logger.setLevel('INFO')
     
-    engine = GameEngine()
+    engine = GameEngine(profiler=Profiler() if '--profile' in sys.argv else None)
     engine.load()
     try:
         engine.run()
     except KeyboardInterrupt:
         logger.info('Saving state, hit ctrl-C again to hard stop')
         engine.save()
+        if engine.profiler is not None:
+            engine.profiler.close()
         asyncio.get_event_loop().close()